@@ -0,0 +1,246 @@
+import os
+import asyncio
+import logging
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Optional
+from app.files import (
+    FILE_CHUNK_SIZE,
+    FILES_PREFIX,
+    FileBody,
+    file_chunks,
+    gzip_file_chunks,
+    prepare_file_upload,
+)
+from app.handlers import (
+    HEAD_TOO_LARGE,
+    KEEP_ALIVE_TIMEOUT,
+    LINGER_TIMEOUT,
+    MAX_HEAD_SIZE,
+    is_upload,
+    route_request,
+    should_keep_alive,
+)
+from app.server import create_listener
+from app.utils import (
+    ParsedRequest,
+    Response,
+    format_response,
+    parse_accept_encoding,
+    parse_request_cached,
+    with_connection_header,
+)
+from app.workers import fork_workers, pin_to_cpu
+
+try:
+    import uvloop  # pylint: disable=import-error
+except ImportError:  # Optional; the stdlib event loop is used without it
+    uvloop = None
+
+# Threads kept only for blocking disk work (open/stat/read/write)
+DISK_WORKERS = 4
+
+
+async def _receive_upload(
+    reader: asyncio.StreamReader,
+    name: bytes,
+    base_directory: str,
+    headers: dict[bytes, bytes],
+) -> tuple[Response, bool]:
+    """Streams an upload body from `reader` into its file without blocking the loop.
+
+    Returns the response and whether the whole body was read, which the
+    connection needs before it can carry another request.
+    """
+
+    error, file_path, content_length = prepare_file_upload(
+        name, base_directory, headers
+    )
+    if error is not None:
+        return error, False
+
+    loop = asyncio.get_running_loop()
+    remaining = content_length
+    try:
+        f = await loop.run_in_executor(None, open, file_path, "wb")
+        with f:
+            while remaining > 0:
+                try:
+                    async with asyncio.timeout(KEEP_ALIVE_TIMEOUT):
+                        chunk = await reader.read(min(remaining, FILE_CHUNK_SIZE))
+                except (TimeoutError, ConnectionError):
+                    break  # Stalled or reset mid-body; treated as incomplete
+                if not chunk:
+                    break
+                await loop.run_in_executor(None, f.write, chunk)
+                remaining -= len(chunk)
+        if remaining:
+            await loop.run_in_executor(None, os.remove, file_path)
+            return format_response("400 Bad Request", "Incomplete request body"), False
+        return format_response("201 Created"), True  # Success response
+    except OSError as e:
+        logging.error("Error writing file %s: %s", file_path, e)
+        response = format_response("500 Internal Server Error", "File write error")
+        return response, False
+
+
+async def _send_file_body(writer: asyncio.StreamWriter, body: FileBody) -> bool:
+    """Sends a file body returned by `route_request` and closes the file.
+
+    Returns False if the file shrank and the response is short of the announced
+    length, in which case the connection must be closed to end it.
+    """
+    loop = asyncio.get_running_loop()
+    with body.file:
+        if not body.compress:
+            await writer.drain()
+            try:
+                sent = await loop.sendfile(writer.transport, body.file, 0, body.size)
+                return sent == body.size
+            except NotImplementedError:
+                pass  # e.g. uvloop; copy the file through the executor instead
+
+        if body.compress:
+            chunks = gzip_file_chunks(body.file, body.size)
+        else:
+            chunks = file_chunks(body.file, body.size)
+        sent = 0
+        while chunk := await loop.run_in_executor(None, next, chunks, b""):
+            writer.write(chunk)
+            sent += len(chunk)
+            await writer.drain()
+        return body.compress or sent == body.size
+
+
+async def _prepare_response(
+    reader: asyncio.StreamReader,
+    request_data: bytes,
+    base_directory: str,
+    parsed_heads: dict[bytes, ParsedRequest],
+) -> tuple[Response, Optional[FileBody], bool]:
+    """Builds the answer to the request whose head is `request_data`.
+
+    Returns the response, the file body that follows it, and whether the
+    connection can carry another request afterwards.
+    """
+    request = parse_request_cached(request_data, parsed_heads)
+    method, path, version, headers = request
+    loop = asyncio.get_running_loop()
+    supported_encodings = parse_accept_encoding(headers)
+    keep_alive = should_keep_alive(method, path, version, headers)
+    body = None
+
+    if is_upload(method, path):
+        response, complete = await _receive_upload(
+            reader, path[len(FILES_PREFIX) :], base_directory, headers
+        )
+        keep_alive = keep_alive and complete
+    elif path and path.startswith(FILES_PREFIX):
+        # Opening and stat-ing the file may block, so it runs off the loop
+        response, body = await loop.run_in_executor(
+            None, route_request, request, supported_encodings, base_directory
+        )
+    else:
+        response, body = route_request(request, supported_encodings, base_directory)
+
+    if keep_alive != (version == b"HTTP/1.1"):  # Differs from the version's default
+        response = with_connection_header(response, keep_alive)
+    return response, body, keep_alive
+
+
+async def _drain_before_close(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """Discards unread input for a moment so closing does not reset the response."""
+    try:
+        await writer.drain()
+        writer.write_eof()
+        async with asyncio.timeout(LINGER_TIMEOUT):
+            while await reader.read(FILE_CHUNK_SIZE):
+                pass
+    except (TimeoutError, OSError):
+        pass  # Close regardless
+
+
+async def _handle_connection(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, base_directory: str
+) -> None:
+    """Serves HTTP requests (GET/POST) on an asyncio stream until either side closes."""
+    writer.get_extra_info("socket").setsockopt(
+        socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1
+    )
+    parsed_heads: dict[bytes, ParsedRequest] = {}
+    responding = False  # Once a head is on the wire, an error can only close
+    try:
+        keep_alive = True
+        while keep_alive:
+            try:
+                async with asyncio.timeout(KEEP_ALIVE_TIMEOUT):
+                    request_data = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, TimeoutError):
+                return  # Client went away or idled before sending a full request head
+            response, body, keep_alive = await _prepare_response(
+                reader, request_data, base_directory, parsed_heads
+            )
+            responding = True
+            writer.writelines(response)
+            if body is not None:
+                keep_alive = await _send_file_body(writer, body) and keep_alive
+            await writer.drain()
+            responding = False
+    except asyncio.LimitOverrunError:
+        writer.writelines(HEAD_TOO_LARGE)
+        await _drain_before_close(reader, writer)
+    except ConnectionError:
+        pass  # Reset by the client; nothing left to answer
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logging.error("Unexpected error handling request: %s", e, exc_info=True)
+        if not responding:
+            writer.writelines(
+                with_connection_header(
+                    format_response("500 Internal Server Error", "Server Error"),
+                    False,
+                )
+            )
+    finally:
+        writer.close()
+
+
+async def _serve(base_directory: str, cpu: Optional[int]) -> None:
+    """Accepts connections on localhost:4221 until the loop is stopped."""
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=DISK_WORKERS))
+
+    server = await asyncio.start_server(
+        partial(_handle_connection, base_directory=base_directory),
+        sock=create_listener(cpu),
+        limit=MAX_HEAD_SIZE,
+    )
+    logging.info(
+        "Server listening on http://localhost:4221 (%s)",
+        "asyncio" if uvloop is None else "uvloop",
+    )
+
+    async with server:
+        await server.serve_forever()
+
+
+def start_async_server(base_directory: str, workers: int = 1) -> None:
+    """Starts the HTTP server on localhost:4221 with an asyncio event loop per worker.
+
+    Each of the `workers` processes binds its own SO_REUSEPORT listener, so the
+    kernel balances new connections between the loops. The loops run on uvloop
+    when it is installed. With several workers, each is pinned to its own CPU.
+    """
+    run = asyncio.run if uvloop is None else uvloop.run
+    try:
+        index = fork_workers(workers - 1)
+        cpu = pin_to_cpu(index) if workers > 1 else None
+        run(_serve(base_directory, cpu))
+    except (PermissionError, OSError) as e:
+        logging.error("Server failed to start due to a system error: %s", e)
+    except KeyboardInterrupt:
+        logging.info("Server shutting down gracefully...")
+        sys.exit(0)
@@ -1,86 +1,365 @@
 import os
-import re
+import stat
+import socket
 import logging
-from app.utils import format_response
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import BinaryIO, Iterator, NamedTuple, Optional
+from app.utils import (
+    ENCODING_GZIP,
+    Response,
+    format_chunk,
+    format_headers,
+    format_response,
+    gzip_compressor,
+)
 
+FILE_CHUNK_SIZE = 64 * 1024
+FILES_PREFIX = b"/files/"
 
-def handle_file_upload(
-    request_data: str, path: str, base_directory: str, headers: dict[str, str]
-) -> bytes:
-    """Handles file upload via POST request to `/files/{filename}`."""
+# Files up to this size are kept in memory (raw and gzipped) between requests
+FILE_CACHE_MAX_FILE_SIZE = 256 * 1024
+FILE_CACHE_MAX_TOTAL_SIZE = 64 * 1024 * 1024
+
+# Files below this size grow rather than shrink once gzip framing is added
+MIN_COMPRESS_SIZE = 256
+# Leading bytes of formats that are already compressed (gzip, zip, jpeg, png)
+_COMPRESSED_MAGIC = (b"\x1f\x8b", b"PK\x03\x04", b"\xff\xd8\xff", b"\x89PNG")
+
+
+
+class FileBody(NamedTuple):
+    """An open file whose contents follow the response head."""
+
+    file: BinaryIO
+    size: int  # Announced in the head; the file may change before it is sent
+    compress: bool  # Sent gzip-compressed in chunks rather than via sendfile
+
+
+def _is_compressible(head: bytes, size: int) -> bool:
+    """Returns False for contents too small to gain from gzip or already compressed.
+
+    `head` is the start of the contents; its first four bytes are enough.
+    """
+    return size >= MIN_COMPRESS_SIZE and not head.startswith(_COMPRESSED_MAGIC)
+
+
+def _is_compressible_file(file: BinaryIO, size: int) -> bool:
+    """Like `_is_compressible`, reading the head from an open file."""
+    if size < MIN_COMPRESS_SIZE:
+        return False
+    head = file.read(4)
+    file.seek(0)
+    return _is_compressible(head, size)
+
+
+def _is_valid_filename(name: bytes) -> bool:
+    """Checks that the part of the path after `/files/` names a single file."""
+    return bool(name) and b"/" not in name
+
+
+@lru_cache(maxsize=1024)
+def _resolve_file_path(base_directory: str, name: bytes) -> Optional[str]:
+    """Returns the path of file `name` inside `base_directory`, or None if outside.
+
+    `base_directory` must already be absolute (it is resolved once at startup), so
+    plain string normalization is enough. The result depends only on the two
+    strings, which makes it safe to cache for repeatedly requested files.
+    """
+    file_path = os.path.normpath(os.path.join(base_directory, os.fsdecode(name)))
+    if not file_path.startswith(os.path.join(base_directory, "")):
+        return None
+    return file_path
+
+
+def _stat_regular_file(file_path: str) -> Optional[os.stat_result]:
+    """Returns the stat of `file_path` if it is a regular file, like `os.path.isfile`."""
+    try:
+        file_stat = os.stat(file_path)
+    except (OSError, ValueError):
+        return None
+    return file_stat if stat.S_ISREG(file_stat.st_mode) else None
+
+
+class _FileCache:
+    """Contents and gzipped forms of small files, least recently used first.
+
+    Entries are keyed by path and hold the (mtime_ns, size) they were read at, so
+    a changed file is read again. Safe to use from any thread.
+    """
+
+    def __init__(self, max_total_size: int) -> None:
+        self._entries: OrderedDict[
+            str, tuple[tuple[int, int], bytes, Optional[bytes]]
+        ] = OrderedDict()
+        self._size = 0  # Bytes held, raw and gzipped
+        self._max_total_size = max_total_size
+        self._lock = threading.Lock()
+
+    def get(
+        self, file_path: str, version: tuple[int, int]
+    ) -> Optional[tuple[bytes, Optional[bytes]]]:
+        """Returns the cached contents and gzipped form if still at `version`."""
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(file_path)
+            return entry[1], entry[2]
+
+    def put(
+        self,
+        file_path: str,
+        version: tuple[int, int],
+        contents: bytes,
+        gzipped: Optional[bytes],
+    ) -> None:
+        """Caches a file's contents, evicting the oldest entries beyond the limit."""
+        with self._lock:
+            previous = self._entries.pop(file_path, None)
+            if previous is not None:
+                self._size -= len(previous[1]) + len(previous[2] or b"")
+            self._entries[file_path] = (version, contents, gzipped)
+            self._size += len(contents) + len(gzipped or b"")
+            while self._size > self._max_total_size:
+                _, (_, old_contents, old_gzipped) = self._entries.popitem(last=False)
+                self._size -= len(old_contents) + len(old_gzipped or b"")
+
+
+_FILE_CACHE = _FileCache(FILE_CACHE_MAX_TOTAL_SIZE)
+
+
+def _read_cached_file(
+    file_path: str, file_stat: os.stat_result
+) -> tuple[bytes, Optional[bytes]]:
+    """Returns a small file's contents and gzipped form, cached while unchanged."""
+    version = (file_stat.st_mtime_ns, file_stat.st_size)
+    cached = _FILE_CACHE.get(file_path, version)
+    if cached is not None:
+        return cached
+
+    with open(file_path, "rb") as f:
+        contents = f.read()
+    gzipped = None
+    if _is_compressible(contents, len(contents)):
+        compressor = gzip_compressor()
+        gzipped = compressor.compress(contents) + compressor.flush()
+
+    _FILE_CACHE.put(file_path, version, contents, gzipped)
+    return contents, gzipped
+
+
+def _receive_into_file(
+    client_socket: socket.socket, file: BinaryIO, remaining: int
+) -> bool:
+    """Copies the next `remaining` bytes from the socket into `file`.
+
+    Returns False if the client closed, reset or stalled the connection before
+    sending them all.
+    """
+    view = memoryview(bytearray(min(remaining, FILE_CHUNK_SIZE)))
+    while remaining > 0:
+        try:
+            received = client_socket.recv_into(view, min(remaining, len(view)))
+        except OSError:  # Timed out or reset; write errors still propagate
+            return False
+        if not received:
+            return False
+        file.write(view[:received])
+        remaining -= received
+    return True
+
+
+def prepare_file_upload(
+    name: bytes, base_directory: str, headers: dict[bytes, bytes]
+) -> tuple[Optional[Response], str, int]:
+    """Validates an upload to `/files/{name}` before any of its body is read.
 
-    match = re.match(r"^/files/([^/]+)$", path)
-    if not match:
-        return format_response("400 Bad Request", "Invalid file request")
+    Returns an error response (or None when the upload may proceed), the
+    destination path and the expected body length.
+    """
 
-    filename = match.group(1)
-    file_path = os.path.abspath(os.path.join(base_directory, filename))
+    if not _is_valid_filename(name):
+        return format_response("400 Bad Request", "Invalid file request"), "", 0
 
     # Prevent directory traversal attacks
-    if not file_path.startswith(os.path.abspath(base_directory)):
-        return format_response("403 Forbidden", "Access Denied")
+    file_path = _resolve_file_path(base_directory, name)
+    if file_path is None:
+        return format_response("403 Forbidden", "Access Denied"), "", 0
+
+    # Only Content-Length framing is supported; a chunked body, or a length
+    # alongside one, could not be told apart from the next request
+    if b"transfer-encoding" in headers:
+        return (
+            format_response("501 Not Implemented", "Transfer-Encoding not supported"),
+            "",
+            0,
+        )
 
     # Validate Content-Length header
-    content_length = headers.get("content-length")
+    content_length = headers.get(b"content-length")
+    if content_length is not None and b"," in content_length:
+        return (
+            format_response("400 Bad Request", "Conflicting Content-Length headers"),
+            "",
+            0,
+        )
     if content_length is None or not content_length.isdigit():
-        return format_response(
-            "411 Length Required", "Content-Length header missing or invalid"
+        return (
+            format_response(
+                "411 Length Required", "Content-Length header missing or invalid"
+            ),
+            "",
+            0,
         )
 
-    content_length = int(content_length)
+    return None, file_path, int(content_length)
 
-    # Extract request body (POST data)
-    request_parts = request_data.split("\r\n\r\n", 1)
-    if len(request_parts) < 2:
-        return format_response("400 Bad Request", "Missing request body")
 
-    request_body = request_parts[1][
-        :content_length
-    ]  # Ensure we only take the expected length
+def _split_upload_body(
+    request_data: bytes, content_length: int
+) -> Optional[tuple[bytes, bytes]]:
+    """Returns the part of the body received so far and the bytes past its end.
+
+    Returns None if `request_data` does not hold a complete request head.
+    """
+    head_end = request_data.find(b"\r\n\r\n")
+    if head_end < 0:
+        return None
+    body_start = head_end + 4
+    body_end = body_start + content_length
+    return request_data[body_start:body_end], request_data[body_end:]
+
+
+def handle_file_upload(
+    client_socket: socket.socket,
+    request_data: bytes,
+    name: bytes,
+    base_directory: str,
+    headers: dict[bytes, bytes],
+) -> tuple[Response, Optional[bytes]]:
+    """Handles file upload via POST request to `/files/{name}`.
+
+    `request_data` holds what has been read from the socket so far, starting with
+    the request head; the rest of the body is streamed from `client_socket`
+    straight into the file. Returns the response and the bytes received past the
+    end of the body, or None when the body was not read in full and the
+    connection cannot carry another request.
+    """
+
+    error, file_path, content_length = prepare_file_upload(
+        name, base_directory, headers
+    )
+    if error is not None:
+        return error, None
+
+    # Extract request body (POST data)
+    split = _split_upload_body(request_data, content_length)
+    if split is None:
+        return format_response("400 Bad Request", "Missing request body"), None
+    request_body, rest = split
 
     try:
-        with open(file_path, "w", encoding="utf-8") as f:
+        with open(file_path, "wb") as f:
             f.write(request_body)
-        return format_response("201 Created")  # Success response
+            complete = _receive_into_file(
+                client_socket, f, content_length - len(request_body)
+            )
+        if not complete:
+            os.remove(file_path)
+            return format_response("400 Bad Request", "Incomplete request body"), None
+        # Success response; anything after the body is the next pipelined request
+        return format_response("201 Created"), rest
     except OSError as e:
-        logging.error("Error writing file %s: %s", filename, e)
-        return format_response("500 Internal Server Error", "File write error")
+        logging.error("Error writing file %s: %s", file_path, e)
+        response = format_response("500 Internal Server Error", "File write error")
+        return response, None
 
 
-def handle_file_request(
-    path: str, base_directory: str, supported_encodings: set[str]
+def format_file_response(
+    content_length: Optional[int], content_encoding: Optional[str] = None
 ) -> bytes:
-    """Handles file retrieval from the specified directory securely with optional compression."""
+    """Formats the status line and headers of a successful file download.
+
+    A `content_length` of None announces a chunked body.
+    """
+    return format_headers(
+        "200 OK", content_length, "application/octet-stream", content_encoding
+    )
+
+
+def _cached_file_response(
+    file_path: str, file_stat: os.stat_result, supported_encodings: int
+) -> Response:
+    """Builds the complete response for a small file, served from memory."""
+    contents, gzipped = _read_cached_file(file_path, file_stat)
+    if gzipped is not None and supported_encodings & ENCODING_GZIP:
+        return format_file_response(len(gzipped), "gzip"), gzipped
+    return format_file_response(len(contents)), contents
+
+
+def _streamed_file_response(
+    file_path: str, file_stat: os.stat_result, supported_encodings: int, chunked: bool
+) -> tuple[Response, FileBody]:
+    """Opens a large file and builds the head of the response that streams it."""
+    file = open(file_path, "rb")  # pylint: disable=consider-using-with
+    try:
+        compress = (
+            chunked
+            and bool(supported_encodings & ENCODING_GZIP)
+            and _is_compressible_file(file, file_stat.st_size)
+        )
+    except BaseException:
+        file.close()
+        raise
+    if compress:
+        # Compressed size is unknown up front, so the body is chunked
+        response = (format_file_response(None, "gzip"),)
+    else:
+        response = (format_file_response(file_stat.st_size),)
+    return response, FileBody(file, file_stat.st_size, compress)
+
+
+def handle_file_request(
+    name: bytes, base_directory: str, supported_encodings: int, chunked: bool = True
+) -> tuple[Response, Optional[FileBody]]:
+    """Handles file retrieval from the specified directory securely with optional compression.
+
+    Returns the response and, for successful downloads, the file body the caller
+    should send after it with `send_file_body`. Pass `chunked=False` for clients
+    older than HTTP/1.1, which cannot take the chunked body that compressing a
+    large file needs; those files are then sent uncompressed.
+    """
 
-    match = re.match(r"^/files/([^/]+)$", path)
     response = None
+    body = None
 
-    if not match:
+    if not _is_valid_filename(name):
         response = format_response(
             "400 Bad Request", "Invalid file request", "text/plain", supported_encodings
         )
     else:
-        filename = match.group(1)
-        file_path = os.path.abspath(os.path.join(base_directory, filename))
+        file_path = _resolve_file_path(base_directory, name)
 
-        if not file_path.startswith(os.path.abspath(base_directory)):
+        if file_path is None:
             response = format_response(
                 "403 Forbidden", "Access Denied", "text/plain", supported_encodings
             )
-        elif not os.path.isfile(file_path):
+        elif (file_stat := _stat_regular_file(file_path)) is None:
             response = format_response(
                 "404 Not Found", "File Not Found", "text/plain", supported_encodings
             )
         else:
             try:
-                with open(file_path, "rb") as f:
-                    file_content = f.read()
-                response = format_response(
-                    "200 OK",
-                    file_content,
-                    "application/octet-stream",
-                    supported_encodings,
-                )
+                if file_stat.st_size <= FILE_CACHE_MAX_FILE_SIZE:
+                    response = _cached_file_response(
+                        file_path, file_stat, supported_encodings
+                    )
+                else:
+                    response, body = _streamed_file_response(
+                        file_path, file_stat, supported_encodings, chunked
+                    )
             except FileNotFoundError:
                 response = format_response(
                     "404 Not Found",
@@ -96,7 +375,7 @@ def handle_file_request(
                     supported_encodings,
                 )
             except OSError as e:
-                logging.error("OS error reading file %s: %s", filename, e)
+                logging.error("OS error reading file %s: %s", file_path, e)
                 response = format_response(
                     "500 Internal Server Error",
                     "OS Error",
@@ -105,7 +384,7 @@ def handle_file_request(
                 )
             except Exception as e:  # pylint: disable=broad-exception-caught
                 logging.critical(
-                    "Unexpected error reading file %s: %s", filename, e, exc_info=True
+                    "Unexpected error reading file %s: %s", file_path, e, exc_info=True
                 )
                 response = format_response(
                     "500 Internal Server Error",
@@ -113,4 +392,39 @@ def handle_file_request(
                     "text/plain",
                     supported_encodings,
                 )
-    return response
+    return response, body
+
+
+def file_chunks(file: BinaryIO, size: int) -> Iterator[bytes]:
+    """Yields the first `size` bytes of the file, or all of it if it is shorter."""
+    while size > 0 and (chunk := file.read(min(size, FILE_CHUNK_SIZE))):
+        size -= len(chunk)
+        yield chunk
+
+
+def gzip_file_chunks(file: BinaryIO, size: int) -> Iterator[bytes]:
+    """Yields the file body gzip-compressed and framed for a chunked response."""
+    compressor = gzip_compressor()
+    for chunk in file_chunks(file, size):
+        compressed = compressor.compress(chunk)
+        if compressed:  # An empty chunk would terminate the body early
+            yield format_chunk(compressed)
+    yield format_chunk(compressor.flush()) + format_chunk(b"")
+
+
+def send_file_body(client_socket: socket.socket, body: FileBody) -> bool:
+    """Sends a file body returned by `handle_file_request` and closes the file.
+
+    Returns False if the file shrank and the response is short of the announced
+    length, in which case the connection must be closed to end it.
+    """
+    with body.file:
+        if not body.compress:
+            # Zero-copy transfer; falls back to send() where sendfile is unavailable.
+            # Bytes appended since the head went out would be read as the next
+            # response, so no more than the announced length is sent.
+            return client_socket.sendfile(body.file, 0, body.size) == body.size
+
+        for chunk in gzip_file_chunks(body.file, body.size):
+            client_socket.sendall(chunk)
+        return True  # A chunked body ends itself, whatever the file's length
@@ -1,61 +1,328 @@
 import socket
-import re
 import logging
-from app.utils import parse_request, format_response
-from app.files import handle_file_request, handle_file_upload
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+from app.utils import (
+    ENCODING_GZIP,
+    ParsedRequest,
+    Response,
+    format_response,
+    parse_accept_encoding,
+    parse_request_cached,
+    send_response,
+    wants_keep_alive,
+    with_connection_header,
+)
+from app.files import (
+    FILE_CHUNK_SIZE,
+    FILES_PREFIX,
+    FileBody,
+    handle_file_request,
+    handle_file_upload,
+    send_file_body,
+)
 
+# A route gets the path suffix after its prefix (empty for exact routes), the
+# HTTP version, the request headers, the accepted encodings and the base directory.
+Route = Callable[
+    [bytes, Optional[bytes], dict[bytes, bytes], int, str],
+    tuple[Response, Optional[FileBody]],
+]
 
-def handle_request(client_socket: socket.socket, base_directory: str) -> None:
-    """Handles an incoming HTTP request (GET/POST) and sends an appropriate response."""
-    try:
-        request_data = client_socket.recv(4096).decode("utf-8")
-        if not request_data:
-            return
-
-        method, path, headers = parse_request(request_data)
-        headers = headers or {}
-
-        accept_encoding = headers.get("accept-encoding", "").lower()
-        supported_encodings = set(accept_encoding.replace(" ", "").split(","))
-
-        # Handle GET requests
-        if method == "GET":
-            if path == "/":
-                response = format_response(
-                    "200 OK", "", "text/plain", supported_encodings
-                )
-            elif match := re.match(r"^/echo/(.+)$", path or ""):
-                response = format_response(
-                    "200 OK", match.group(1), "text/plain", supported_encodings
-                )
-            elif path == "/user-agent":
-                response = format_response(
-                    "200 OK",
-                    headers.get("user-agent", "Unknown"),
-                    "text/plain",
-                    supported_encodings,
-                )
-            elif path and path.startswith("/files/"):
-                response = handle_file_request(
-                    path, base_directory, supported_encodings
-                )
-            else:
-                response = format_response(
-                    "404 Not Found", "Not Found", "text/plain", supported_encodings
-                )
-
-        # Handle POST requests
-        elif method == "POST" and path and path.startswith("/files/"):
-            response = handle_file_upload(request_data, path, base_directory, headers)
+KEEP_ALIVE_TIMEOUT = 5  # Seconds a connection may sit idle between requests
+# Also the size of each connection's receive buffer, which a head must fit in
+MAX_HEAD_SIZE = 16 * 1024
+# How long unread input is drained after an early response before closing
+LINGER_TIMEOUT = 1.0
+
+# Fixed responses, built once for clients with and without gzip
+_ROOT_RESPONSES = {
+    encodings: format_response("200 OK", "", "text/plain", encodings)
+    for encodings in (0, ENCODING_GZIP)
+}
+_NOT_FOUND_RESPONSES = {
+    encodings: format_response("404 Not Found", "Not Found", "text/plain", encodings)
+    for encodings in (0, ENCODING_GZIP)
+}
+_METHOD_NOT_ALLOWED = format_response(
+    "405 Method Not Allowed", "Only GET and POST supported"
+)
+HEAD_TOO_LARGE = with_connection_header(
+    format_response("431 Request Header Fields Too Large", "Request head too large"),
+    False,
+)
+
+
+def _handle_root(
+    _suffix: bytes,
+    _version: Optional[bytes],
+    _headers: dict[bytes, bytes],
+    supported_encodings: int,
+    _base_directory: str,
+) -> tuple[Response, Optional[FileBody]]:
+    """Handles `GET /`."""
+    return _ROOT_RESPONSES[supported_encodings & ENCODING_GZIP], None
+
+
+def _handle_user_agent(
+    _suffix: bytes,
+    _version: Optional[bytes],
+    headers: dict[bytes, bytes],
+    supported_encodings: int,
+    _base_directory: str,
+) -> tuple[Response, Optional[FileBody]]:
+    """Handles `GET /user-agent` by echoing the User-Agent header."""
+    response = format_response(
+        "200 OK",
+        headers.get(b"user-agent", b"Unknown"),
+        "text/plain",
+        supported_encodings,
+    )
+    return response, None
+
+
+def _handle_echo(
+    suffix: bytes,
+    _version: Optional[bytes],
+    _headers: dict[bytes, bytes],
+    supported_encodings: int,
+    _base_directory: str,
+) -> tuple[Response, Optional[FileBody]]:
+    """Handles `GET /echo/{text}`."""
+    if not suffix:
+        return _not_found(supported_encodings), None
+    return format_response("200 OK", suffix, "text/plain", supported_encodings), None
+
+
+def _handle_files(
+    suffix: bytes,
+    version: Optional[bytes],
+    _headers: dict[bytes, bytes],
+    supported_encodings: int,
+    base_directory: str,
+) -> tuple[Response, Optional[FileBody]]:
+    """Handles `GET /files/{name}`."""
+    return handle_file_request(
+        suffix, base_directory, supported_encodings, chunked=version == b"HTTP/1.1"
+    )
+
+
+def _not_found(supported_encodings: int) -> Response:
+    """Returns the response for paths that match no route."""
+    return _NOT_FOUND_RESPONSES[supported_encodings & ENCODING_GZIP]
+
+
+_EXACT_ROUTES: dict[bytes, Route] = {
+    b"/": _handle_root,
+    b"/user-agent": _handle_user_agent,
+}
+_PREFIX_ROUTES: tuple[tuple[bytes, Route], ...] = (
+    (b"/echo/", _handle_echo),
+    (FILES_PREFIX, _handle_files),
+)
+
+
+def route_request(
+    request: ParsedRequest, supported_encodings: int, base_directory: str
+) -> tuple[Response, Optional[FileBody]]:
+    """Builds the response for every route except uploads, which stream their body.
+
+    `request` is the method, path, version and headers from `parse_request`.
+    Returns the response and, for file downloads, the file body that follows it.
+    """
+    method, path, version, headers = request
+
+    # Handle GET requests
+    if method != b"GET" or path is None:
+        return _METHOD_NOT_ALLOWED, None
+
+    route = _EXACT_ROUTES.get(path)
+    suffix = b""
+    if route is None:
+        for prefix, prefix_route in _PREFIX_ROUTES:
+            if path.startswith(prefix):
+                route, suffix = prefix_route, path[len(prefix) :]
+                break
         else:
-            response = format_response(
-                "405 Method Not Allowed", "Only GET and POST supported"
-            )
+            return _not_found(supported_encodings), None
+
+    return route(suffix, version, headers, supported_encodings, base_directory)
+
+
+def is_upload(method: Optional[bytes], path: Optional[bytes]) -> bool:
+    """Returns True for requests handled by the streaming file upload route."""
+    return method == b"POST" and bool(path) and path.startswith(FILES_PREFIX)
+
 
-        client_socket.sendall(response)
+def should_keep_alive(
+    method: Optional[bytes],
+    path: Optional[bytes],
+    version: Optional[bytes],
+    headers: dict[bytes, bytes],
+) -> bool:
+    """Returns True if the connection can carry another request after this one.
+
+    Only uploads read a request body, so any other request that comes with one
+    closes the connection rather than have its body parsed as the next request.
+    Chunked bodies are never read, so a Transfer-Encoding closes it on any
+    request (RFC 9112 6.1).
+    """
+    if b"transfer-encoding" in headers:
+        return False
+    if not is_upload(method, path) and headers.get(b"content-length", b"0") != b"0":
+        return False
+    return wants_keep_alive(version, headers)
+
+
+def _prepare_response(
+    client_socket: socket.socket,
+    request_data: bytes,
+    base_directory: str,
+    parsed_heads: dict[bytes, ParsedRequest],
+) -> tuple[Response, Optional[FileBody], Optional[bytes]]:
+    """Builds the answer to the request whose complete head starts `request_data`.
+
+    Returns the response, the file body that follows it, and the bytes received
+    after the request, or None in their place if the connection should then be
+    closed.
+    """
+    head_end = request_data.find(b"\r\n\r\n") + 4
+    request = parse_request_cached(request_data[:head_end], parsed_heads)
+    method, path, version, headers = request
+    supported_encodings = parse_accept_encoding(headers)
+    keep_alive = should_keep_alive(method, path, version, headers)
+    body = None
+
+    # Handle POST requests
+    if is_upload(method, path):
+        response, rest = handle_file_upload(
+            client_socket,
+            request_data,
+            path[len(FILES_PREFIX) :],
+            base_directory,
+            headers,
+        )
+        keep_alive = keep_alive and rest is not None
+    else:
+        response, body = route_request(request, supported_encodings, base_directory)
+        rest = request_data[head_end:]
+
+    if keep_alive != (version == b"HTTP/1.1"):  # Differs from the version's default
+        response = with_connection_header(response, keep_alive)
+    return response, body, rest if keep_alive else None
+
+
+def _drain_before_close(client_socket: socket.socket) -> None:
+    """Discards the client's unread input for a moment before the socket closes.
+
+    Closing with input still unread makes the kernel reset the connection, and
+    the client may then lose the response it was sent. Shutting down the write
+    side first delivers it, and gives the client time to stop sending.
+    """
+    deadline = time.monotonic() + LINGER_TIMEOUT
+    try:
+        client_socket.shutdown(socket.SHUT_WR)
+        while (remaining := deadline - time.monotonic()) > 0:
+            client_socket.settimeout(remaining)
+            if not client_socket.recv(FILE_CHUNK_SIZE):
+                return  # The client has closed its side too
+    except OSError:
+        pass  # Timed out or reset; close regardless
+
+
+@dataclass(eq=False)  # Compared and hashed by identity, as pollers key on it
+class Connection:
+    """A client socket and the bytes received on it that are not yet answered.
+
+    Outlives the calls to `handle_request` in between which it sits idle.
+    """
+
+    socket: socket.socket
+    buffer: Optional[bytearray] = None  # Only held while reading a request
+    filled: int = 0  # Bytes of `buffer` holding data not yet answered
+    parsed_heads: dict[bytes, ParsedRequest] = field(default_factory=dict)
+
+    def __post_init__(self) -> None:
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.socket.settimeout(KEEP_ALIVE_TIMEOUT)
+
+
+def _receive_head(connection: Connection, buffer: bytearray) -> bool:
+    """Reads from the socket until `buffer` holds a complete request head.
+
+    Returns False if the client closed the connection first, or if the head did
+    not fit in the buffer, in which case a 431 has been sent.
+    """
+    client_socket = connection.socket
+    view = memoryview(buffer)
+    filled = connection.filled
+    head_end = buffer.find(b"\r\n\r\n", 0, filled)
+    while head_end < 0:
+        if filled == len(buffer):
+            send_response(client_socket, HEAD_TOO_LARGE)
+            _drain_before_close(client_socket)
+            return False
+        received = client_socket.recv_into(view[filled:])
+        if not received:
+            return False  # Client closed the connection between requests
+        # Only the new bytes can complete the terminator, so scan just those
+        head_end = buffer.find(b"\r\n\r\n", max(0, filled - 3), filled + received)
+        filled += received
+        connection.filled = filled
+    return True
+
+
+def handle_request(connection: Connection, base_directory: str) -> bool:
+    """Serves the HTTP requests (GET/POST) that arrive on a now readable connection.
+
+    Requests that were pipelined behind one another are answered in order from
+    the bytes already received before the socket is read again. Returns True
+    once everything received has been answered and the connection is waiting
+    for its next request, which the caller should watch for without holding a
+    thread; otherwise the connection has been closed.
+    """
+    client_socket = connection.socket
+    if connection.buffer is None:
+        connection.buffer = bytearray(MAX_HEAD_SIZE)
+    buffer = connection.buffer
+    view = memoryview(buffer)
+    answered = False  # Whether this call has answered a request yet
+    responding = False  # Once a head is on the wire, an error can only close
+    idle = False
+    try:
+        while True:
+            if answered and not connection.filled:
+                connection.buffer = None  # Idle connections hold no buffer
+                idle = True
+                return True
+            if not _receive_head(connection, buffer):
+                return False
+
+            response, body, rest = _prepare_response(
+                client_socket,
+                bytes(view[: connection.filled]),
+                base_directory,
+                connection.parsed_heads,
+            )
+            responding = True
+            send_response(client_socket, response, more=body is not None)
+            if body is not None and not send_file_body(client_socket, body):
+                return False  # Cut short; only closing can end the response
+            responding = False
+            answered = True
+            if rest is None:
+                return False
+            buffer[: len(rest)] = rest  # Keep any pipelined request for the next pass
+            connection.filled = len(rest)
+    except (TimeoutError, ConnectionError):
+        pass  # Stalled past the timeout or reset by the client; just close
     except Exception as e:  # pylint: disable=broad-exception-caught
         logging.error("Unexpected error handling request: %s", e, exc_info=True)
-        response = format_response("500 Internal Server Error", "Server Error")
-        client_socket.sendall(response)
+        if not responding:
+            response = format_response("500 Internal Server Error", "Server Error")
+            send_response(client_socket, with_connection_header(response, False))
     finally:
-        client_socket.close()
+        if not idle:
+            client_socket.close()
+    return False
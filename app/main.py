@@ -1,8 +1,11 @@
+import os
 import logging
 import sys
 import argparse
 from pathlib import Path
+from app.async_server import start_async_server
 from app.server import start_server
+from app.utils import GZIP_LEVEL, set_gzip_level
 
 # Configure logging
 logging.basicConfig(
@@ -19,6 +22,26 @@ if __name__ == "__main__":
         default="/tmp",
         help="Directory to serve files from (default: /tmp)",
     )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="Serve connections from an asyncio event loop (uvloop if installed) "
+        "instead of a thread pool",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of server processes (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--gzip-level",
+        type=int,
+        choices=range(1, 10),
+        default=GZIP_LEVEL,
+        metavar="{1..9}",
+        help=f"gzip compression level, 1 fastest (default: {GZIP_LEVEL})",
+    )
     args = parser.parse_args()
 
     base_directory = Path(args.directory).resolve()
@@ -28,9 +51,12 @@ if __name__ == "__main__":
         sys.exit(1)
 
     logging.info("Serving files from: %s", base_directory)
+    set_gzip_level(args.gzip_level)
 
     try:
-        start_server(str(base_directory))  # Convert Path object back to string
+        serve = start_async_server if args.asyncio else start_server
+        # Convert Path object back to string
+        serve(str(base_directory), max(1, args.workers))
     except KeyboardInterrupt:
         logging.info("Server shutting down gracefully...")
         sys.exit(0)
@@ -1,24 +1,260 @@
+import os
+import queue
+import selectors
 import socket
 import logging
 import sys
-from concurrent.futures import ThreadPoolExecutor
-from app.handlers import handle_request
+import threading
+import time
+from typing import Optional
+from app.handlers import (
+    KEEP_ALIVE_TIMEOUT,
+    MAX_HEAD_SIZE,
+    Connection,
+    handle_request,
+)
+from app.sharded_pool import ShardedExecutor
+from app.utils import format_response, with_connection_header
+from app.workers import fork_workers, pin_to_cpu
 
+POOL_SIZE = max(10, (os.cpu_count() or 1) * 2)  # Threads across all workers
+MIN_POOL_SIZE = 4  # Threads per worker process, however many workers there are
+PENDING_PER_THREAD = 4  # Requests running or queued per thread before a 503
+LISTEN_BACKLOG = 4096
+# The kernel caps these at the net.core.rmem_max / net.core.wmem_max sysctls;
+# raise those to at least this size for the buffers to take full effect.
+SOCKET_BUFFER_SIZE = 12 << 20
+# Seconds the listener goes unwatched after accept() fails, e.g. out of descriptors
+ACCEPT_RETRY_DELAY = 1.0
+_SO_INCOMING_CPU = getattr(socket, "SO_INCOMING_CPU", None)  # Linux only
 
-def start_server(base_directory: str) -> None:
-    """Starts the HTTP server on localhost:4221 with multithreading support."""
+
+def create_listener(cpu: Optional[int] = None) -> socket.socket:
+    """Creates this process's SO_REUSEPORT listener on localhost:4221.
+
+    Buffer sizes and TCP_NODELAY are set before listen() so every accepted
+    socket inherits them and the window scale is negotiated for the full buffer.
+    With `cpu`, the kernel prefers this listener for connections whose packets
+    are received on that CPU, keeping each one on the core that accepts it.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        with socket.create_server(
-            ("localhost", 4221), reuse_port=True
-        ) as server_socket:
-            server_socket.listen(5)
-            logging.info("Server listening on http://localhost:4221")
+        if cpu is not None and _SO_INCOMING_CPU is not None:
+            listener.setsockopt(socket.SOL_SOCKET, _SO_INCOMING_CPU, cpu)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        listener.bind(("localhost", 4221))
+        listener.listen(LISTEN_BACKLOG)
+    except BaseException:
+        listener.close()
+        raise
+    return listener
+
+
+_SERVICE_UNAVAILABLE = b"".join(
+    with_connection_header(
+        format_response("503 Service Unavailable", "Server busy, try again later"),
+        False,
+    )
+)
+
+
+def _reject(client_socket: socket.socket) -> None:
+    """Answers a request the pool has no room for with a 503 and closes it."""
+    try:
+        # Take in the waiting request first; closing with it unread would reset
+        # the connection before the client reads the 503
+        client_socket.setblocking(False)
+        client_socket.recv(MAX_HEAD_SIZE)
+        client_socket.sendall(_SERVICE_UNAVAILABLE)
+    except OSError:
+        pass  # The client is gone already; nothing left to tell it
+    finally:
+        client_socket.close()
+
+
+class _ConnectionPoller:
+    """Watches idle connections from the accepting thread until they are readable.
+
+    Pool threads hand connections back with `park`; everything else runs on the
+    accepting thread only.
+    """
+
+    def __init__(self, server_socket: socket.socket) -> None:
+        server_socket.setblocking(False)
+        self._server_socket = server_socket
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(server_socket, selectors.EVENT_READ)
+        # Parked connections come back through a queue plus a self-pipe wakeup,
+        # since the selector itself must not be touched from other threads
+        self._parked: queue.SimpleQueue[Connection] = queue.SimpleQueue()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ)
+        # When each watched connection went idle. All share one timeout, so
+        # insertion order is also expiry order.
+        self._idle_since: dict[Connection, float] = {}
+        # When to watch the listener again after accepting failed, if it did
+        self._accept_resumes: Optional[float] = None
+
+    def park(self, connection: Connection) -> None:
+        """Returns a connection that awaits its next request; safe from any thread."""
+        self._parked.put(connection)
+        try:
+            self._wakeup_writer.send(b"\0")
+        except BlockingIOError:
+            pass  # Plenty of wakeups are pending already
+
+    def ready(self) -> list[Connection]:
+        """Waits for connections with a request to read and stops watching them.
+
+        Connections idle for longer than `KEEP_ALIVE_TIMEOUT` are closed.
+        """
+        deadlines = [] if self._accept_resumes is None else [self._accept_resumes]
+        if self._idle_since:
+            oldest = next(iter(self._idle_since.values()))
+            deadlines.append(oldest + KEEP_ALIVE_TIMEOUT)
+        timeout = None
+        if deadlines:
+            timeout = max(0.0, min(deadlines) - time.monotonic())
+
+        readable = []
+        for key, _ in self._selector.select(timeout):
+            if key.fileobj is self._server_socket:
+                self._accept()
+            elif key.fileobj is self._wakeup_reader:
+                self._take_parked()
+            else:
+                connection = key.data
+                self._selector.unregister(connection.socket)
+                del self._idle_since[connection]
+                readable.append(connection)
 
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                while True:
-                    client_socket, client_address = server_socket.accept()
-                    logging.info("New connection from %s", client_address)
-                    executor.submit(handle_request, client_socket, base_directory)
+        resumes = self._accept_resumes
+        if resumes is not None and time.monotonic() >= resumes:
+            self._selector.register(self._server_socket, selectors.EVENT_READ)
+            self._accept_resumes = None
+        self._close_expired()
+        return readable
+
+    def _watch(self, connection: Connection) -> None:
+        """Starts watching `connection` for its next request."""
+        self._selector.register(connection.socket, selectors.EVENT_READ, connection)
+        self._idle_since[connection] = time.monotonic()
+
+    def _accept(self) -> None:
+        """Accepts every pending connection; each is served once its request arrives."""
+        while True:
+            try:
+                client_socket, client_address = self._server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionAbortedError:
+                continue  # Reset while still queued; there is nothing to serve
+            except OSError as e:
+                # Out of descriptors (EMFILE, ENFILE) or kernel memory. Retrying
+                # at once would spin, so leave the pending connections queued in
+                # the kernel for a moment while busy connections finish.
+                logging.error("Error accepting a connection: %s", e)
+                self._selector.unregister(self._server_socket)
+                self._accept_resumes = time.monotonic() + ACCEPT_RETRY_DELAY
+                return
+            logging.debug("New connection from %s", client_address)
+            try:
+                connection = Connection(client_socket)
+            except OSError:
+                client_socket.close()  # Reset before its options could be set
+                continue
+            self._watch(connection)
+
+    def _take_parked(self) -> None:
+        """Watches the connections pool threads have handed back."""
+        try:
+            while self._wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                connection = self._parked.get_nowait()
+            except queue.Empty:
+                return
+            self._watch(connection)
+
+    def _close_expired(self) -> None:
+        """Closes the connections that have been idle for too long."""
+        deadline = time.monotonic() - KEEP_ALIVE_TIMEOUT
+        while self._idle_since:
+            connection, idle_since = next(iter(self._idle_since.items()))
+            if idle_since > deadline:
+                return
+            del self._idle_since[connection]
+            self._selector.unregister(connection.socket)
+            connection.socket.close()
+
+
+def _serve_connection(
+    connection: Connection,
+    base_directory: str,
+    slots: threading.BoundedSemaphore,
+    poller: _ConnectionPoller,
+) -> None:
+    """Serves a readable connection on a pool thread, then parks it if still open."""
+    try:
+        idle = handle_request(connection, base_directory)
+    finally:
+        slots.release()
+    if idle:
+        poller.park(connection)
+
+
+def _serve_forever(
+    server_socket: socket.socket, base_directory: str, pool_size: int
+) -> None:
+    """Accepts connections and hands their requests to a bounded thread pool.
+
+    Between requests, connections wait in a poller on this thread rather than
+    holding a pool thread, so idle keep-alive clients cost only a descriptor.
+    """
+    # The executor's own queues are unbounded, so cap the backlog of work here
+    slots = threading.BoundedSemaphore(pool_size * PENDING_PER_THREAD)
+    poller = _ConnectionPoller(server_socket)
+    with ShardedExecutor(max_workers=pool_size) as executor:
+        while True:
+            for connection in poller.ready():
+                # The slot is released by the pool thread that serves the request
+                # pylint: disable-next=consider-using-with
+                if not slots.acquire(blocking=False):
+                    logging.warning("Rejecting a request: server busy")
+                    _reject(connection.socket)
+                    continue
+                executor.submit(
+                    _serve_connection, connection, base_directory, slots, poller
+                )
+
+
+def start_server(base_directory: str, workers: int = 1) -> None:
+    """Starts the HTTP server on localhost:4221 with multithreading support.
+
+    Each of the `workers` processes binds its own SO_REUSEPORT listener and runs
+    its own pool with a share of the `POOL_SIZE` threads, so the kernel balances
+    connections across separate accept queues and CPU-bound work such as gzip is
+    not serialized on one GIL.
+    With several workers, each is pinned to its own CPU and takes the
+    connections that arrive there.
+    """
+    try:
+        # Fork before any sockets or threads exist so every worker starts clean
+        index = fork_workers(workers - 1)
+        cpu = pin_to_cpu(index) if workers > 1 else None
+        pool_size = max(MIN_POOL_SIZE, POOL_SIZE // workers)
+        with create_listener(cpu) as server_socket:
+            logging.info("Server listening on http://localhost:4221")
+            _serve_forever(server_socket, base_directory, pool_size)
 
     except (PermissionError, OSError, socket.error) as e:
         logging.error("Server failed to start due to a system error: %s", e)
@@ -0,0 +1,132 @@
+import collections
+import itertools
+import queue
+import threading
+from concurrent.futures import Executor, Future
+from typing import Any, Callable
+
+WORKERS_PER_SHARD = 2
+
+
+class ShardedExecutor(Executor):
+    """Thread pool that spreads submitted work over several queues.
+
+    `ThreadPoolExecutor` feeds every worker from one queue, so the submitting
+    thread contends with all workers on each hand-off. Here each shard of
+    `WORKERS_PER_SHARD` workers owns a queue, submissions go round-robin over the
+    shards, and a worker with nothing queued at home steals from its siblings.
+    A worker that finds every queue empty sleeps until a submission wakes it.
+    """
+
+    def __init__(self, max_workers: int) -> None:
+        num_shards = max(1, max_workers // WORKERS_PER_SHARD)
+        self._shards: list[queue.SimpleQueue] = [
+            queue.SimpleQueue() for _ in range(num_shards)
+        ]
+        self._next_shard = itertools.count()
+        # Wakeup queues of the sleeping workers, most recently idle last. Work is
+        # queued before a sleeper is taken from here, and a worker rechecks the
+        # queues after adding itself, so one of the two always sees the other.
+        self._sleeping: collections.deque[queue.SimpleQueue] = collections.deque()
+        self._shutdown = threading.Event()
+        self._threads = [
+            threading.Thread(
+                target=self._work,
+                args=(index % num_shards,),
+                name=f"ShardedExecutor-{index}",
+                daemon=True,
+            )
+            for index in range(max_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(  # pylint: disable=arguments-differ
+        self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any
+    ) -> Future:
+        if self._shutdown.is_set():
+            raise RuntimeError("cannot schedule new futures after shutdown")
+
+        future: Future = Future()
+        shard = self._shards[next(self._next_shard) % len(self._shards)]
+        shard.put((future, fn, args, kwargs))
+        self._wake_one()
+        return future
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        self._shutdown.set()
+        if cancel_futures:
+            for shard in self._shards:
+                while True:
+                    try:
+                        future, *_ = shard.get_nowait()
+                    except queue.Empty:
+                        break
+                    future.cancel()
+        for _ in self._threads:
+            self._wake_one()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _wake_one(self) -> None:
+        """Wakes the most recently idle sleeping worker, if any, to look for work."""
+        try:
+            wakeup = self._sleeping.pop()
+        except IndexError:
+            return  # Every worker is busy and rechecks the queues when done
+        wakeup.put(None)
+
+    def _take(self, home: int) -> Any:
+        """Takes work from the worker's own queue first, then from its siblings."""
+        num_shards = len(self._shards)
+        for offset in range(num_shards):
+            try:
+                return self._shards[(home + offset) % num_shards].get_nowait()
+            except queue.Empty:
+                continue
+        return None
+
+    def _next_item(self, home: int, wakeup: queue.SimpleQueue) -> Any:
+        """Returns the next queued call, sleeping until one is submitted if needed.
+
+        Returns None once the executor is shut down and every queue is empty.
+        """
+        while True:
+            item = self._take(home)
+            if item is not None:
+                return item
+            if self._shutdown.is_set():
+                return None
+
+            self._sleeping.append(wakeup)
+            item = self._take(home)  # Work queued before we were listed
+            if item is None and not self._shutdown.is_set():
+                wakeup.get()
+            try:
+                self._sleeping.remove(wakeup)
+            except ValueError:
+                # A submission took us to wake up. If we are leaving with other
+                # work, its item still needs a worker, so pass the wakeup on.
+                if item is not None:
+                    self._wake_one()
+            if item is not None:
+                return item
+
+    def _work(self, home: int) -> None:
+        """Runs submitted calls until the executor is shut down and drained."""
+        wakeup: queue.SimpleQueue = queue.SimpleQueue()
+        while True:
+            item = self._next_item(home, wakeup)
+            if item is None:
+                return  # Every queue was empty after shutdown; nothing left
+
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:  # pylint: disable=broad-exception-caught
+                future.set_exception(e)
+            else:
+                future.set_result(result)
@@ -1,49 +1,276 @@
-import gzip
+import socket
+import threading
+import zlib
+from functools import lru_cache
 from typing import Optional, Tuple
 
+# An encoded response: the status line and headers followed by the body buffers
+Response = tuple[bytes, ...]
+# Method, path, version and headers of a request, as returned by `parse_request`
+ParsedRequest = Tuple[
+    Optional[bytes], Optional[bytes], Optional[bytes], dict[bytes, bytes]
+]
 
-def parse_request(
-    request_data: str,
-) -> Tuple[Optional[str], Optional[str], dict[str, str]]:
-    """Parses the HTTP request and returns method, path, and headers."""
-    lines = request_data.split("\r\n")
-    if not lines or len(lines[0].split(" ")) < 3:
-        return None, None, {}  # Malformed request
+# Content codings accepted by the client, as bits of an int
+ENCODING_GZIP = 1
+ENCODING_DEFLATE = 2
+ENCODING_BR = 4
 
-    method, path, _ = lines[0].split(" ")
-    headers = {
-        key.strip().lower(): value.strip()
-        for line in lines[1:]
-        if ": " in line
-        for key, value in [line.split(":", 1)]
-    }
+_COMPRESSIBLE_TYPES = ("text/", "application/json", "application/xml")
 
-    return method, path, headers
+GZIP_LEVEL = 1  # Override with `set_gzip_level`
+GZIP_WBITS = 31  # zlib window size with a gzip header and trailer
+# Bodies up to this size have their gzipped form memoized, since many repeat
+GZIP_CACHE_MAX_BODY_SIZE = 64 * 1024
+
+_compressors = threading.local()
+
+# Holds a sent head back to share a TCP segment with the body that follows
+_MSG_MORE = getattr(socket, "MSG_MORE", 0)  # Linux only
+
+# Encoded status line and fixed headers keyed by (status, content type, encoding).
+# Keys only ever come from the handlers' literals, so the cache stays tiny.
+_HDR_CACHE: dict[tuple[str, str, Optional[str]], bytes] = {}
+# Content-Length lines that end a head, for the small lengths that keep recurring
+_LEN_CACHE: dict[int, bytes] = {}
+_LEN_CACHE_MAX_LENGTH = 4096
+# Complete responses without a body, keyed by (status, content type, gzipped)
+_EMPTY_RESPONSES: dict[tuple[str, str, bool], Response] = {}
+
+_ACCEPT_ENCODING_BITS = {
+    b"gzip": ENCODING_GZIP,
+    b"x-gzip": ENCODING_GZIP,  # Legacy alias, to be treated as gzip (RFC 9110 8.4.1.3)
+    b"deflate": ENCODING_DEFLATE,
+    b"br": ENCODING_BR,
+}
+_REFUSED = {b"q=0", b"q=0.", b"q=0.0", b"q=0.00", b"q=0.000"}
+
+
+# Distinct request heads each connection keeps parsed
+REQUEST_CACHE_SIZE = 8
+
+
+def parse_request(request_data: bytes) -> ParsedRequest:
+    """Parses the HTTP request head and returns method, path, version and headers."""
+    head_end = request_data.find(b"\r\n\r\n")
+    if head_end < 0:
+        head_end = len(request_data)  # Head cut short by the read; parse what arrived
+
+    # One C-level split of the head does the line scanning in a single pass
+    lines = request_data[:head_end].split(b"\r\n")
+    request_line = lines[0].split(b" ")
+    if len(request_line) != 3:
+        return None, None, None, {}  # Malformed request
+
+    method, path, version = request_line
+    headers: dict[bytes, bytes] = {}
+    for line in lines[1:]:
+        key, colon, value = line.partition(b":")
+        if colon:
+            # Field names cannot contain whitespace (RFC 9112 5.1), so only the
+            # value needs stripping; bytes.lower() already maps ASCII only
+            key = key.lower()
+            value = value.strip()
+            if key in headers:
+                # A repeated field combines into one list (RFC 9110 5.3), so that
+                # conflicting framing headers are seen rather than overwritten
+                value = headers[key] + b", " + value
+            headers[key] = value
+
+    return method, path, version, headers
+
+
+def parse_request_cached(
+    head: bytes, cache: dict[bytes, ParsedRequest]
+) -> ParsedRequest:
+    """Like `parse_request` for a complete head, reusing earlier parses of it.
+
+    `cache` belongs to one connection, where clients tend to repeat the same
+    request, and keeps its last `REQUEST_CACHE_SIZE` distinct heads. Parses are
+    shared between requests, so callers must not modify the returned headers.
+    """
+    parsed = cache.get(head)
+    if parsed is None:
+        if len(cache) >= REQUEST_CACHE_SIZE:
+            del cache[next(iter(cache))]  # Evict the oldest head
+        parsed = cache[head] = parse_request(head)
+    return parsed
+
+
+def wants_keep_alive(version: Optional[bytes], headers: dict[bytes, bytes]) -> bool:
+    """Returns True if the client expects the connection to stay open afterwards.
+
+    HTTP/1.1 connections persist unless the client sends `Connection: close`;
+    HTTP/1.0 ones only when it asks for `Connection: keep-alive`.
+    """
+    connection = headers.get(b"connection", b"").lower()
+    if version == b"HTTP/1.1":
+        return b"close" not in connection
+    return version == b"HTTP/1.0" and b"keep-alive" in connection
+
+
+def with_connection_header(response: Response, keep_alive: bool) -> Response:
+    """Returns `response` with a `Connection` header saying whether it persists."""
+    token = b"keep-alive" if keep_alive else b"close"
+    head = b"%sConnection: %s\r\n\r\n" % (response[0][:-2], token)
+    return (head, *response[1:])
+
+
+def parse_accept_encoding(headers: dict[bytes, bytes]) -> int:
+    """Returns the content codings the client accepts as `ENCODING_*` bits."""
+    return _parse_accept_encoding(headers.get(b"accept-encoding", b""))
+
+
+# Clients send only a few distinct values, so each is normally parsed once
+@lru_cache(maxsize=64)
+def _parse_accept_encoding(accept_encoding: bytes) -> int:
+    """Returns the `ENCODING_*` bits for a raw Accept-Encoding value."""
+    encodings = 0
+    for token in accept_encoding.lower().split(b","):
+        coding, _, params = token.partition(b";")
+        if params.replace(b" ", b"") in _REFUSED:
+            continue  # An explicit q=0 means "not acceptable"
+        encodings |= _ACCEPT_ENCODING_BITS.get(coding.strip(), 0)
+    return encodings
+
+
+def set_gzip_level(level: int) -> None:
+    """Sets the compression level of all gzip responses (1 fastest, 9 smallest)."""
+    global GZIP_LEVEL  # pylint: disable=global-statement
+    GZIP_LEVEL = level
+    _gzip_memoized.cache_clear()
+
+
+def gzip_compressor(level: Optional[int] = None) -> "zlib._Compress":
+    """Returns a fresh gzip compressor, copied from a pristine per-thread one for `level`."""
+    if level is None:
+        level = GZIP_LEVEL
+    cache = getattr(_compressors, "by_level", None)
+    if cache is None:
+        cache = _compressors.by_level = {}
+    pristine = cache.get(level)
+    if pristine is None:
+        pristine = cache[level] = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return pristine.copy()
+
+
+@lru_cache(maxsize=256)
+def _gzip_memoized(body: bytes, level: int) -> bytes:
+    """Returns `body` gzip-compressed, reusing the result when the same body repeats."""
+    compressor = gzip_compressor(level)
+    return compressor.compress(body) + compressor.flush()
+
+
+def format_chunk(data: bytes) -> bytes:
+    """Frames `data` as a single chunk of a `Transfer-Encoding: chunked` body."""
+    # One allocation sized for the framed chunk, with a single copy of `data`
+    return b"%x\r\n%s\r\n" % (len(data), data)
+
+
+def _header_prefix(
+    status_code: str, content_type: str, content_encoding: Optional[str]
+) -> bytes:
+    """Returns the cached status line and headers that precede the body framing."""
+    key = (status_code, content_type, content_encoding)
+    prefix = _HDR_CACHE.get(key)
+    if prefix is None:
+        prefix = b"HTTP/1.1 %s\r\nContent-Type: %s\r\n" % (
+            status_code.encode("ascii"),
+            content_type.encode("ascii"),
+        )
+        if content_encoding:
+            prefix += b"Content-Encoding: %s\r\n" % content_encoding.encode("ascii")
+        _HDR_CACHE[key] = prefix
+    return prefix
+
+
+def format_headers(
+    status_code: str,
+    content_length: Optional[int],
+    content_type: str = "text/plain",
+    content_encoding: Optional[str] = None,
+) -> bytes:
+    """Formats the status line and headers for a response whose body is sent separately.
+
+    A `content_length` of None announces a chunked body instead.
+    """
+    prefix = _header_prefix(status_code, content_type, content_encoding)
+    if content_length is None:
+        return prefix + b"Transfer-Encoding: chunked\r\n\r\n"
+    length_line = _LEN_CACHE.get(content_length)
+    if length_line is None:
+        length_line = b"Content-Length: %d\r\n\r\n" % content_length
+        if content_length < _LEN_CACHE_MAX_LENGTH:
+            _LEN_CACHE[content_length] = length_line
+    return prefix + length_line
 
 
 def format_response(
     status_code: str,
     body: str | bytes = "",
     content_type: str = "text/plain",
-    supported_encodings: Optional[set[str]] = None,
-) -> bytes:
-    """Formats an HTTP response with given status, body, and headers."""
+    supported_encodings: int = 0,
+) -> Response:
+    """Formats an HTTP response with given status, body, and headers.
+
+    The head and body stay separate buffers so `send_response` can hand them to
+    the kernel in one scatter-gather write without concatenating them.
+    """
+
+    # gzip is the only coding we produce
+    compress = bool(supported_encodings & ENCODING_GZIP) and content_type.startswith(
+        _COMPRESSIBLE_TYPES
+    )
+    if not body:  # The same few empty responses recur, so each is built once
+        key = (status_code, content_type, compress)
+        response = _EMPTY_RESPONSES.get(key)
+        if response is not None:
+            return response
 
     if isinstance(body, str):
         response_body = body.encode("utf-8")  # Convert string to bytes
     else:  # body is guaranteed to be bytes here
         response_body = body
 
-    headers = [
-        f"HTTP/1.1 {status_code}",
-        f"Content-Type: {content_type}",
-    ]
+    content_encoding = None
+    body_parts: Response = (response_body,)
+    if compress:
+        if len(response_body) <= GZIP_CACHE_MAX_BODY_SIZE:
+            body_parts = (_gzip_memoized(response_body, GZIP_LEVEL),)
+        else:
+            compressor = gzip_compressor()
+            body_parts = (compressor.compress(response_body), compressor.flush())
+        content_encoding = "gzip"
+
+    content_length = sum(map(len, body_parts))
+    response = (
+        format_headers(status_code, content_length, content_type, content_encoding),
+        *body_parts,
+    )
+    if not body:
+        _EMPTY_RESPONSES[key] = response
+    return response
+
 
-    if "gzip" in (supported_encodings or set()):
-        response_body = gzip.compress(response_body)
-        headers.append("Content-Encoding: gzip")
+def send_response(
+    client_socket: socket.socket, response: Response, more: bool = False
+) -> None:
+    """Sends all parts of `response`, using a single `sendmsg` call where possible.
 
-    headers.append(f"Content-Length: {len(response_body)}")
-    headers.append("\r\n")  # End of headers
+    Pass `more` when a body is sent separately right after, so the kernel can
+    pack the head into the same segment instead of pushing it out on its own.
+    """
+    if not hasattr(client_socket, "sendmsg"):  # e.g. Windows
+        for part in response:
+            client_socket.sendall(part)
+        return
 
-    return "\r\n".join(headers).encode("utf-8") + response_body
+    flags = _MSG_MORE if more else 0
+    buffers = [memoryview(part) for part in response if part]
+    while buffers:
+        sent = client_socket.sendmsg(buffers, (), flags)
+        # Drop the buffers that went out whole and trim a partially sent one
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers.pop(0))
+        if sent:
+            buffers[0] = buffers[0][sent:]
@@ -0,0 +1,58 @@
+import os
+import signal
+import sys
+from typing import Optional
+
+
+def _stop_workers(pids: list[int]) -> None:
+    """Terminates and reaps the worker processes, then exits the parent."""
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass  # Already exited
+    for pid in pids:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+    sys.exit(0)
+
+
+def fork_workers(count: int) -> int:
+    """Forks `count` additional processes that continue running the caller's code.
+
+    Listening sockets created before the call are shared with the children, so
+    the kernel spreads incoming connections across all processes. SIGTERM sent
+    to the parent is forwarded to the children. Platforms without `os.fork` keep
+    a single process.
+
+    Returns the calling process's worker index: 0 in the parent and 1 to `count`
+    in the children.
+    """
+    if not hasattr(os, "fork"):
+        return 0
+
+    pids = []
+    for index in range(1, count + 1):
+        pid = os.fork()
+        if pid == 0:
+            return index  # Children serve; only the parent manages the workers
+        pids.append(pid)
+
+    if pids:
+        signal.signal(signal.SIGTERM, lambda *_: _stop_workers(pids))
+    return 0
+
+
+def pin_to_cpu(index: int) -> Optional[int]:
+    """Pins the calling process to the `index`-th CPU it may run on.
+
+    Returns that CPU, or None where CPU affinity is unsupported.
+    """
+    if not hasattr(os, "sched_setaffinity"):  # e.g. macOS
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    cpu = cpus[index % len(cpus)]
+    os.sched_setaffinity(0, {cpu})
+    return cpu